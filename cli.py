@@ -1,14 +1,44 @@
+import os
 import typer
 from pathlib import Path
-from utils import move_by_flag_and_copy_dir_structure, delete_by_flag
+from utils import move_by_flag_and_copy_dir_structure, delete_by_flag, summarize_photos
 
 app = typer.Typer()
 
+_JUNK_NAMES = {
+    '.DS_Store': 'ds_store',
+    '.localized': 'localized',
+    'Thumbs.db': 'other_hidden',
+}
+
+
+def _iter_files(root):
+    """
+    Walk root with os.scandir and yield (name, path) string pairs for every file.
+    Symlinks and hidden directories are not followed.
+    """
+    stack = [os.fspath(root)]
+    while stack:
+        d = stack.pop()
+        try:
+            it = os.scandir(d)
+        except OSError:
+            # Skip unreadable directories, as Path.rglob did
+            continue
+        with it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    if not entry.name.startswith('.'):
+                        stack.append(entry.path)
+                elif entry.is_file(follow_symlinks=False):
+                    yield entry.name, entry.path
+
 
 @app.command()
 def remove_forked_files(target_dir: Path) -> None:
     if not target_dir.is_dir():
-        print("Invalid Dir: {target_dir}")
+        print(f"Invalid Dir: {target_dir}")
+        return
 
     junk_files = {
         'ds_store': [],
@@ -18,31 +48,31 @@ def remove_forked_files(target_dir: Path) -> None:
     }
 
 
-    for f in target_dir.rglob("*"):
-        if f.is_file:
-            match f.name:
-                case '.DS_Store':
-                    junk_files['ds_store'].append(f)
-                case '.localized':
-                    junk_files['localized'].append(f)
-                case 'Thumbs.db':
-                    junk_files['other_hidden'].append(f)
-                case f if f.startswith("._"):
-                    junk_files['forked_files'].append(f)
-                case _:
-                    pass
+    junk_bucket = _JUNK_NAMES.get
+    for name, path in _iter_files(target_dir):
+        bucket = junk_bucket(name)
+        if bucket is None and name.startswith("._"):
+            bucket = 'forked_files'
+        if bucket is not None:
+            junk_files[bucket].append(path)
 
     print(f"Total count of files to be deleted: {sum(map(len, junk_files.values()))}")
     see_files: str = typer.prompt("Would you like to see the files or go ahead and delete them? S for see and D for delete")
     if see_files == "S":
         for l in junk_files.values():
             for f in l:
-                print(type(f))
                 print(f)
     # elif see_files == "D":
     #     for p in junk_files.values()
 
 
+@app.command()
+def summarize(source_dir: str):
+    s = Path(source_dir)
+    for key, count in summarize_photos(s).items():
+        print(f"{key}: {count}")
+
+
 @app.command()
 def move_files_by_flag(source_dir: str, flag: str, destination_dir: str):
     s = Path(source_dir)
@@ -0,0 +1,319 @@
+import builtins
+import errno
+import io
+import json
+import os
+import shutil
+from pathlib import Path
+
+import pytest
+
+import utils
+
+XMP_TEMPLATE = (
+    '<?xml version="1.0"?>\n'
+    '<x:xmpmeta xmlns:x="adobe:ns:meta/">'
+    '<rdf:RDF xmlns:rdf="http://www.w3.org/1999/02/22-rdf-syntax-ns#">'
+    '<rdf:Description xmlns:xmp="http://ns.adobe.com/xap/1.0/" xmp:Label="{label}"/>'
+    '</rdf:RDF></x:xmpmeta>'
+)
+
+
+@pytest.fixture(autouse=True)
+def flag_cache_path(tmp_path, monkeypatch):
+    cache_path = tmp_path / 'cache' / 'xmp_flags.json'
+    monkeypatch.setattr(utils, '_FLAG_CACHE_PATH', cache_path)
+    return cache_path
+
+
+def make_photo(directory: Path, name: str, label: str) -> tuple[Path, Path]:
+    directory.mkdir(parents=True, exist_ok=True)
+    raw_file = directory / name
+    raw_file.write_bytes(b'raw')
+    xmp_file = directory / f"{name}.xmp"
+    xmp_file.write_text(XMP_TEMPLATE.format(label=label))
+    return raw_file, xmp_file
+
+
+def test_delete_by_flag_removes_raw_and_xmp(tmp_path, capsys):
+    library = tmp_path / 'library'
+    red_photos = [
+        make_photo(library / 'day1', 'IMG_1.CR2', 'Red'),
+        make_photo(library / 'day2', 'IMG_2.NEF', 'Reject'),
+    ]
+    green_raw, green_xmp = make_photo(library / 'day1', 'IMG_3.CR2', 'Green')
+
+    utils.delete_by_flag(source_dir=library, flag='red')
+
+    assert "Deleted 2 photos" in capsys.readouterr().out
+    for raw_file, xmp_file in red_photos:
+        assert not raw_file.exists()
+        assert not xmp_file.exists()
+    assert green_raw.exists()
+    assert green_xmp.exists()
+
+
+def test_delete_by_flag_simulate_keeps_files(tmp_path, capsys):
+    library = tmp_path / 'library'
+    raw_file, xmp_file = make_photo(library, 'IMG_1.CR2', 'Red')
+
+    utils.delete_by_flag(source_dir=library, flag='red', simulate=True)
+
+    assert "Simulated run would have deleted 1 photos" in capsys.readouterr().out
+    assert raw_file.exists()
+    assert xmp_file.exists()
+
+
+def test_flag_cache_hit_skips_parsing(tmp_path, monkeypatch):
+    library = tmp_path / 'library'
+    raw_file, xmp_file = make_photo(library, 'IMG_1.CR2', 'Red')
+
+    assert list(utils.iter_photos(library, 'red')) == [(raw_file, xmp_file)]
+
+    def fail_parse(xmp_file_path):
+        raise AssertionError(f"{xmp_file_path} should have come from the cache")
+
+    monkeypatch.setattr(utils, 'parse_xmp_flag', fail_parse)
+    assert list(utils.iter_photos(library, 'red')) == [(raw_file, xmp_file)]
+
+
+def test_flag_cache_not_rewritten_without_changes(tmp_path, monkeypatch):
+    library = tmp_path / 'library'
+    make_photo(library, 'IMG_1.CR2', 'Red')
+    utils.summarize_photos(library)
+
+    saves = []
+    monkeypatch.setattr(utils, 'save_flag_cache', saves.append)
+    utils.summarize_photos(library)
+    list(utils.iter_photos(library, 'red'))
+
+    assert saves == []
+
+
+def test_flag_cache_miss_on_mtime_change(tmp_path):
+    library = tmp_path / 'library'
+    _, xmp_file = make_photo(library, 'IMG_1.CR2', 'Red')
+    assert utils.summarize_photos(library)['red'] == 1
+
+    # Same size as 'Red', so only the mtime tells the cache the label changed
+    st = xmp_file.stat()
+    xmp_file.write_text(XMP_TEMPLATE.format(label='Tan'))
+    os.utime(xmp_file, ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000_000))
+    assert xmp_file.stat().st_size == st.st_size
+
+    results = utils.summarize_photos(library)
+    assert results['red'] == 0
+    assert results['unflagged'] == 1
+
+
+def test_flag_cache_prunes_missing_sidecars(tmp_path):
+    library = tmp_path / 'library'
+    make_photo(library, 'IMG_1.CR2', 'Red')
+    gone_raw, gone_xmp = make_photo(library, 'IMG_2.CR2', 'Green')
+    utils.summarize_photos(library)
+    assert str(gone_xmp) in utils.load_flag_cache()
+
+    gone_raw.unlink()
+    gone_xmp.unlink()
+    utils.summarize_photos(library)
+
+    assert str(gone_xmp) not in utils.load_flag_cache()
+
+
+def test_flag_cache_forgets_deleted_photos(tmp_path):
+    library = tmp_path / 'library'
+    _, red_xmp = make_photo(library, 'IMG_1.CR2', 'Red')
+    _, green_xmp = make_photo(library, 'IMG_2.CR2', 'Green')
+
+    utils.delete_by_flag(source_dir=library, flag='red')
+
+    cache = utils.load_flag_cache()
+    assert str(red_xmp) not in cache
+    assert str(green_xmp) in cache
+
+
+def test_flag_cache_ignores_other_versions(tmp_path, flag_cache_path):
+    library = tmp_path / 'library'
+    _, xmp_file = make_photo(library, 'IMG_1.CR2', 'Red')
+    st = xmp_file.stat()
+    flag_cache_path.parent.mkdir(parents=True)
+    flag_cache_path.write_text(json.dumps({
+        'version': utils._FLAG_CACHE_VERSION + 1,
+        'entries': {str(xmp_file): [st.st_mtime_ns, st.st_size, 'green']},
+    }))
+
+    assert utils.load_flag_cache() == {}
+    assert utils.summarize_photos(library)['red'] == 1
+
+
+def test_missing_source_dir_finds_nothing(tmp_path, capsys):
+    missing = tmp_path / 'nope'
+
+    assert utils.find_raw_files(missing) == []
+    utils.delete_by_flag(source_dir=missing, flag='red')
+
+    assert "Deleted 0 photos" in capsys.readouterr().out
+
+
+def make_alt_named_photos(directory: Path, stem: str, label: str, extensions) -> tuple[list[Path], Path]:
+    directory.mkdir(parents=True, exist_ok=True)
+    raw_files = []
+    for extension in extensions:
+        raw_file = directory / f"{stem}{extension}"
+        raw_file.write_bytes(b'raw')
+        raw_files.append(raw_file)
+    xmp_file = directory / f"{stem}.xmp"
+    xmp_file.write_text(XMP_TEMPLATE.format(label=label))
+    return raw_files, xmp_file
+
+
+def test_move_keeps_raws_sharing_a_sidecar_together(tmp_path, capsys):
+    library = tmp_path / 'library'
+    destination = tmp_path / 'destination'
+    raw_files, xmp_file = make_alt_named_photos(library / 'day1', 'B', 'Red', ['.CR2', '.NEF'])
+
+    assert utils.summarize_photos(library)['red'] == 2
+    utils.move_by_flag_and_copy_dir_structure(source_dir=library, flag='red', destination_dir=destination)
+
+    assert "Moved 2 photos" in capsys.readouterr().out
+    for raw_file in raw_files:
+        assert not raw_file.exists()
+        assert (destination / 'day1' / raw_file.name).exists()
+    assert not xmp_file.exists()
+    assert (destination / 'day1' / xmp_file.name).exists()
+
+
+def test_delete_by_flag_removes_raws_sharing_a_sidecar(tmp_path, capsys):
+    library = tmp_path / 'library'
+    raw_files, xmp_file = make_alt_named_photos(library, 'B', 'Red', ['.CR2', '.NEF'])
+
+    utils.delete_by_flag(source_dir=library, flag='red')
+
+    assert "Deleted 2 photos" in capsys.readouterr().out
+    assert not any(raw_file.exists() for raw_file in raw_files)
+    assert not xmp_file.exists()
+
+
+def test_move_by_flag_moves_pairs_into_parent_dir(tmp_path, capsys):
+    library = tmp_path / 'library'
+    destination = tmp_path / 'destination'
+    red_raw, red_xmp = make_photo(library / 'day1', 'IMG_1.CR2', 'Red')
+    green_raw, green_xmp = make_photo(library / 'day1', 'IMG_2.CR2', 'Green')
+
+    utils.move_by_flag_and_copy_dir_structure(source_dir=library, flag='red', destination_dir=destination)
+
+    assert "Moved 1 photos" in capsys.readouterr().out
+    assert not red_raw.exists()
+    assert not red_xmp.exists()
+    assert (destination / 'day1' / red_raw.name).read_bytes() == b'raw'
+    assert (destination / 'day1' / red_xmp.name).exists()
+    assert green_raw.exists()
+    assert green_xmp.exists()
+
+
+def test_move_by_flag_falls_back_to_shutil_move_on_exdev(tmp_path, monkeypatch):
+    library = tmp_path / 'library'
+    destination = tmp_path / 'destination'
+    raw_file, xmp_file = make_photo(library / 'day1', 'IMG_1.CR2', 'Red')
+
+    real_replace = os.replace
+    real_move = shutil.move
+    fallback_moves = []
+
+    def cross_device_replace(src, dst):
+        # Only photo moves cross a device, the flag cache writes still work
+        if os.fspath(src).startswith(os.fspath(library)):
+            raise OSError(errno.EXDEV, os.strerror(errno.EXDEV), src)
+        real_replace(src, dst)
+
+    def recording_move(src, dst):
+        fallback_moves.append(Path(src))
+        return real_move(src, dst)
+
+    monkeypatch.setattr(utils.os, 'replace', cross_device_replace)
+    monkeypatch.setattr(utils.shutil, 'move', recording_move)
+
+    utils.move_by_flag_and_copy_dir_structure(source_dir=library, flag='red', destination_dir=destination)
+
+    assert sorted(fallback_moves) == sorted([raw_file, xmp_file])
+    assert (destination / 'day1' / raw_file.name).exists()
+    assert (destination / 'day1' / xmp_file.name).exists()
+    assert not raw_file.exists()
+    assert not xmp_file.exists()
+
+
+def record_opens(monkeypatch) -> list[str]:
+    opened = []
+    real_os_open = os.open
+    real_open = builtins.open
+
+    def recording_os_open(path, *args, **kwargs):
+        opened.append(os.fspath(path))
+        return real_os_open(path, *args, **kwargs)
+
+    def recording_open(file, *args, **kwargs):
+        if not isinstance(file, int):
+            opened.append(os.fspath(file))
+        return real_open(file, *args, **kwargs)
+
+    monkeypatch.setattr(os, 'open', recording_os_open)
+    monkeypatch.setattr(builtins, 'open', recording_open)
+    # pathlib opens through io.open rather than the builtin
+    monkeypatch.setattr(io, 'open', recording_open)
+    return opened
+
+
+def test_cold_run_opens_each_sidecar_once(tmp_path, monkeypatch):
+    library = tmp_path / 'library'
+    xmp_files = [make_photo(library / 'day1', f'IMG_{i}.CR2', 'Red')[1] for i in range(3)]
+    opened = record_opens(monkeypatch)
+
+    assert len(list(utils.iter_photos(library, 'red'))) == 3
+    assert sorted(path for path in opened if path.lower().endswith('.xmp')) == sorted(map(str, xmp_files))
+
+
+def test_warm_flag_cache_opens_no_sidecars(tmp_path, monkeypatch):
+    library = tmp_path / 'library'
+    for i in range(3):
+        make_photo(library / 'day1', f'IMG_{i}.CR2', 'Red')
+    assert len(list(utils.iter_photos(library, 'red'))) == 3
+    opened = record_opens(monkeypatch)
+
+    assert len(list(utils.iter_photos(library, 'red'))) == 3
+    assert utils.summarize_photos(library)['red'] == 3
+    assert [path for path in opened if path.lower().endswith('.xmp')] == []
+
+
+def test_flag_cache_drops_malformed_entries(tmp_path, flag_cache_path):
+    library = tmp_path / 'library'
+    _, xmp_file = make_photo(library, 'IMG_1.CR2', 'Red')
+    _, other_xmp = make_photo(library, 'IMG_2.CR2', 'Green')
+    st = xmp_file.stat()
+    flag_cache_path.parent.mkdir(parents=True)
+    flag_cache_path.write_text(json.dumps({
+        'version': utils._FLAG_CACHE_VERSION,
+        'entries': {
+            str(xmp_file): 5,
+            str(other_xmp): [st.st_mtime_ns, st.st_size, 'purple'],
+            '/elsewhere.xmp': [1, 2, 'red'],
+        },
+    }))
+
+    assert utils.load_flag_cache() == {'/elsewhere.xmp': [1, 2, 'red']}
+    results = utils.summarize_photos(library)
+    assert results['red'] == 1
+    assert results['green'] == 1
+
+
+def test_invalid_sidecar_falls_back_to_alt_name(tmp_path):
+    library = tmp_path / 'library'
+    raw_file, bad_xmp = make_photo(library, 'IMG_1.CR2', 'Red')
+    bad_xmp.write_text('not an xmp file at all')
+    alt_xmp = library / 'IMG_1.xmp'
+    alt_xmp.write_text(XMP_TEMPLATE.format(label='Green'))
+    make_photo(library, 'IMG_2.CR2', 'Red')[1].write_text('not an xmp file either')
+
+    results = utils.summarize_photos(library)
+    assert results['green'] == 1
+    assert results['skipped_no_xmp'] == 1
+    assert list(utils.iter_photos(library, 'green')) == [(raw_file, alt_xmp)]
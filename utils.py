@@ -1,146 +1,416 @@
 
+import errno
 import os
-import xml.etree.ElementTree as ET
+import json
 from pathlib import Path
 import logging
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
 import shutil
 
+from lxml import etree
+
 logger = logging.getLogger(__name__)
 
-def find_raw_files(selected_dir: Path):
-    raw_extensions = {
-        '.cr2',
-        '.cr3',
-        '.nef',
-        '.arw',
-    }
+_RAW_EXTENSIONS = frozenset({
+    '.cr2',
+    '.cr3',
+    '.nef',
+    '.arw',
+})
+
 
+def _is_raw_file(name: str) -> bool:
+    # macOS resource forks share the extension of the real file
+    if name.startswith('._'):
+        return False
+    dot = name.rfind('.')
+    return dot >= 0 and name[dot:].lower() in _RAW_EXTENSIONS
+
+
+def _find_raw_files_in(top: str) -> list[Path]:
     raw_files = []
 
-    for root, dirs, files in os.walk(selected_dir):
-        logger.critical(f"Root: {root} -> Dir: {dirs} -> Files: {files}")
+    for root, dirs, files in os.walk(top):
+        # Prune hidden directories before the walk descends into them
+        dirs[:] = [d for d in dirs if not d.startswith('.')]
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Root: %s files=%d", root, len(files))
         for file in files:
-            if Path(file).suffix.lower() in raw_extensions:
-                raw_files.append(Path(root)/file)
+            if _is_raw_file(file):
+                raw_files.append(Path(os.path.join(root, file)))
 
     return raw_files
 
 
-def is_valid_xmp_file(xmp_file_path):
+def find_raw_files(selected_dir: Path):
     """
-    Check if an XMP file is valid and not a system/hidden file.
-    Returns True if the file appears to be a valid XMP file.
+    Find all raw files under selected_dir.
+    Each first level subdirectory is walked on its own worker thread so the
+    directory listings can overlap, which helps most on networked storage.
+    """
+    raw_files = []
+    subdirs = []
+    files = []
+
+    try:
+        with os.scandir(selected_dir) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    if not entry.name.startswith('.'):
+                        subdirs.append(entry.path)
+                else:
+                    files.append(entry.name)
+    except OSError as e:
+        logger.error(f"Warning: Cannot read directory {selected_dir}: {e}")
+        return raw_files
+
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Root: %s files=%d", selected_dir, len(files))
+    for file in files:
+        if _is_raw_file(file):
+            raw_files.append(Path(os.path.join(selected_dir, file)))
+
+    max_workers = min(32, (os.cpu_count() or 1) * 4)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(_find_raw_files_in, d) for d in subdirs]
+        for future in as_completed(futures):
+            raw_files.extend(future.result())
+
+    return raw_files
+
+
+def _is_xmp_candidate(name: str, size: int) -> bool:
+    """
+    Check the name and size of a possible XMP file, the checks that need no read.
     """
     # Skip macOS resource fork files and other hidden files
-    if xmp_file_path.name.startswith('._') or xmp_file_path.name.startswith('.'):
+    if name.startswith('.'):
         return False
 
     # Check if file is empty or too small to be valid XMP
-    try:
-        if xmp_file_path.stat().st_size < 10:
-            return False
-    except OSError:
+    return size >= 10
+
+
+def _is_valid_xmp(name: str, size: int, first_bytes: bytes) -> bool:
+    """
+    Check if an XMP file is valid and not a system/hidden file, given its name,
+    size and first bytes. Returns True if the file appears to be a valid XMP file.
+    """
+    if not _is_xmp_candidate(name, size):
         return False
 
-    # Try to read the first few bytes to check for XML declaration
-    try:
-        with open(xmp_file_path, 'rb') as f:
-            first_bytes = f.read(100)
+    # Check for XML declaration or common XMP markers
+    first_text = first_bytes[:100].decode('utf-8', errors='ignore').lower()
 
-        # Check for XML declaration or common XMP markers
-        first_text = first_bytes.decode('utf-8', errors='ignore').lower()
+    # Valid XMP files should contain XML-like content
+    # If it doesn't look like XML, it's probably not a valid XMP file
+    return any(marker in first_text for marker in ['<?xml', '<x:xmpmeta', '<rdf:', 'xmlns'])
 
-        # Valid XMP files should contain XML-like content
-        if any(marker in first_text for marker in ['<?xml', '<x:xmpmeta', '<rdf:', 'xmlns']):
-            return True
 
-        # If it doesn't look like XML, it's probably not a valid XMP file
-        return False
+def list_dir_entries(directory) -> dict[str, os.DirEntry]:
+    """
+    Return the entries of a directory keyed by lowercased name using a single
+    scandir call. Lowercasing matches sidecars like IMG_1.XMP the way a
+    case-insensitive filesystem (the macOS default) would.
+    """
+    try:
+        with os.scandir(directory) as it:
+            return {entry.name.lower(): entry for entry in it}
+    except OSError:
+        return {}
 
-    except (UnicodeDecodeError, OSError):
-        return False
+
+def _xmp_candidates(raw_file_path) -> tuple[str, str]:
+    # Check for sidecar XMP file
+    raw_str = os.fspath(raw_file_path)
+    xmp_sidecar = raw_str + '.xmp'
+    # Alternative naming pattern: filename.xmp (without raw extension)
+    xmp_alt = os.path.splitext(raw_str)[0] + '.xmp'
+    return xmp_sidecar, xmp_alt
 
 
-def find_xmp_file(raw_file_path):
+def _xmp_candidate_entries(raw_file_path, dir_entries: dict[str, os.DirEntry]) -> list[os.DirEntry]:
     """
-    Find the corresponding XMP file for a raw file.
-    Checks for both sidecar (.xmp) files and filters out invalid files.
+    Return the DirEntries in dir_entries that could be the XMP file for a raw
+    file, in lookup order. Nothing is opened or validated.
     """
-    # Check for sidecar XMP file
-    xmp_sidecar = raw_file_path.with_suffix(raw_file_path.suffix + '.xmp')
-    if xmp_sidecar.exists() and is_valid_xmp_file(xmp_sidecar):
-        return xmp_sidecar
+    entries = []
+    for candidate in _xmp_candidates(raw_file_path):
+        entry = dir_entries.get(os.path.basename(candidate).lower())
+        if entry is not None and entry not in entries:
+            entries.append(entry)
+    return entries
 
-    # Alternative naming pattern: filename.xmp (without raw extension)
-    xmp_alt = raw_file_path.with_suffix('.xmp')
-    if xmp_alt.exists() and is_valid_xmp_file(xmp_alt):
-        return xmp_alt
+
+_LABEL_TAG = '{http://ns.adobe.com/xap/1.0/}Label'
+_DESC_TAG = '{http://www.w3.org/1999/02/22-rdf-syntax-ns#}Description'
+
+_XMP_PARSER = etree.XMLParser(huge_tree=False, recover=True)
+
+_RED_LABELS = frozenset({'red', 'reject'})
+_GREEN_LABELS = frozenset({'green', 'approved', 'select'})
+
+
+def _flag_for_label(label: str | None) -> str | None:
+    label_value = (label or '').strip().lower()
+
+    # Check for red flags
+    if label_value in _RED_LABELS:
+        return 'red'
+
+    # Check for green flags
+    if label_value in _GREEN_LABELS:
+        return 'green'
 
     return None
 
+
+def _read_xmp_file(xmp_file_path: Path) -> bytes | None:
+    """
+    Read an XMP file in one go and validate the bytes in memory, so the file
+    is opened only once per parse.
+    Returns None if the file cannot be read or is not a valid XMP file.
+    """
+    try:
+        data = xmp_file_path.read_bytes()
+    except OSError:
+        return None
+
+    if not _is_valid_xmp(xmp_file_path.name, len(data), data):
+        return None
+
+    return data
+
+
 def parse_xmp_flag(xmp_file_path) -> str | None:
+    return _parse_xmp_file(xmp_file_path)[1]
+
+
+def _parse_xmp_file(xmp_file_path) -> tuple[bool, str | None]:
+    """
+    Read and parse an XMP file, returning (valid, flag).
+    valid is False when the file cannot be read or is not an XMP file at all,
+    so callers can tell a missing sidecar from an unflagged one.
+    """
+    data = _read_xmp_file(xmp_file_path)
+    if data is None:
+        return False, None
+
     try:
-        if not is_valid_xmp_file(xmp_file_path):
-            return None
-
-        tree = ET.parse(xmp_file_path)
-        root = tree.getroot()
-
-        namespaces = {
-            'x': 'adobe:ns:meta/',
-            'rdf': 'http://www.w3.org/1999/02/22-rdf-syntax-ns#',
-            'xmp': 'http://ns.adobe.com/xap/1.0/'
-        }
-
-        label_elements = root.findall('.//xmp:Label', namespaces)
-        if not label_elements:
-            label_elements = root.findall('.//{http://ns.adobe.com/xap/1.0/}Label')
-
-        if not label_elements:
-            rdf_descriptions = root.findall('.//rdf:Description', namespaces)
-            for desc in rdf_descriptions:
-                # Check for xmp:Label as an attribute
-                xmp_label = desc.get('{http://ns.adobe.com/xap/1.0/}Label')
-                if xmp_label:
-                    label_value = xmp_label.lower().strip()
-
-                    # Check for red flags
-                    if label_value in ['red', 'reject']:
-                        return 'red'
-
-                    # Check for green flags
-                    if label_value in ['green', 'approved', 'select']:
-                        return 'green'
-
-                # Process found label elements
-        for element in label_elements:
-            if element.text:
-                label_value = element.text.lower().strip()
-
-                # Check for red flags
-                if label_value in ['red', 'reject']:
-                    return 'red'
-
-                # Check for green flags
-                if label_value in ['green', 'approved', 'select']:
-                    return 'green'
-
-    except ET.ParseError as e:
+        # Most sidecars carry no label at all, so skip the XML parse for those
+        if b'Label' not in data:
+            return True, None
+
+        root = etree.fromstring(data, parser=_XMP_PARSER)
+        if root is None:
+            logger.error(f"Warning: Skipping malformed XMP File: {xmp_file_path.name}")
+            return True, None
+
+        # Label stored as an xmp:Label attribute on rdf:Description. Checked first
+        # since Description usually appears before any Label subelement.
+        for desc in root.iter(_DESC_TAG):
+            flag = _flag_for_label(desc.get(_LABEL_TAG))
+            if flag:
+                return True, flag
+
+        # Label stored as <xmp:Label> elements
+        for element in root.iter(_LABEL_TAG):
+            flag = _flag_for_label(element.text)
+            if flag:
+                return True, flag
+
+    except etree.XMLSyntaxError as e:
         logger.error(f"Warning: Skipping malformed XMP File: {xmp_file_path.name}: {e}")
     except UnicodeDecodeError as e:
         logger.error(f"Warning: Encoding error in XMP File: {xmp_file_path.name}: {e}")
     except Exception as e:
         logger.error(f"Warning: Error processing XMP file: {xmp_file_path.name}: {e}")
 
-    return None
+    return True, None
 
 
-def analyze_photos(directory):
+def _parse_xmp_candidates(xmp_files: list[Path]) -> tuple[int | None, str | None]:
+    """
+    Parse candidate XMP files in order and return (index, flag) for the first
+    valid one, or (None, None) if none is valid.
+    """
+    for index, xmp_file in enumerate(xmp_files):
+        valid, flag = _parse_xmp_file(xmp_file)
+        if valid:
+            return index, flag
+
+    return None, None
+
+
+def _iter_xmp_dirs(raw_files):
+    """
+    Yield, per directory, a list of (raw_file, candidates) for each raw file in
+    it, where candidates are the possible XMP DirEntries (see
+    _xmp_candidate_entries). Each directory is listed in full before its list
+    is yielded, so callers may move or delete the files without disturbing
+    later lookups.
+    """
+    raw_files_by_dir = defaultdict(list)
+    for raw_file in raw_files:
+        raw_files_by_dir[raw_file.parent].append(raw_file)
+
+    for parent, dir_raw_files in raw_files_by_dir.items():
+        dir_entries = list_dir_entries(parent)
+        yield [(raw_file, _xmp_candidate_entries(raw_file, dir_entries)) for raw_file in dir_raw_files]
+
+
+_FLAG_CACHE_PATH = Path(os.environ.get('XDG_CACHE_HOME') or Path.home() / '.cache') / 'photo_utils' / 'xmp_flags.json'
+# Bump whenever parse_xmp_flag can return a different flag for the same file
+_FLAG_CACHE_VERSION = 1
+_CACHED_FLAGS = ('red', 'green', None)
+
+
+def load_flag_cache() -> dict:
+    """
+    Load the XMP flag cache, a mapping of absolute XMP path to
+    [st_mtime_ns, st_size, flag].
+    A missing, unreadable or outdated cache is treated as empty, and malformed
+    entries are dropped.
+    """
+    try:
+        with open(_FLAG_CACHE_PATH, encoding='utf-8') as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+    if not isinstance(cache, dict) or cache.get('version') != _FLAG_CACHE_VERSION:
+        return {}
+
+    entries = cache.get('entries')
+    if not isinstance(entries, dict):
+        return {}
+
+    return {key: value for key, value in entries.items() if _is_cache_entry(value)}
+
+
+def _is_cache_entry(value) -> bool:
+    return (
+        isinstance(value, list)
+        and len(value) == 3
+        and all(type(n) is int for n in value[:2])
+        and value[2] in _CACHED_FLAGS
+    )
+
+
+def save_flag_cache(cache: dict):
+    try:
+        _FLAG_CACHE_PATH.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = _FLAG_CACHE_PATH.with_name(_FLAG_CACHE_PATH.name + '.tmp')
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'version': _FLAG_CACHE_VERSION, 'entries': cache}, f)
+        os.replace(tmp_path, _FLAG_CACHE_PATH)
+    except OSError as e:
+        logger.error(f"Warning: Could not write XMP flag cache {_FLAG_CACHE_PATH}: {e}")
+
+
+def _xmp_signature(xmp_stat: os.stat_result) -> list[int]:
+    # Sidecars rewritten in place keep their directory mtime, so key on the file itself
+    return [xmp_stat.st_mtime_ns, xmp_stat.st_size]
+
+
+def _lookup_flag(cache: dict, key: str, signature: list[int]) -> tuple[bool, str | None]:
+    cached = cache.get(key)
+    if cached and cached[:2] == signature:
+        return True, cached[2]
+    return False, None
+
+
+def _match_sidecar(candidates: list[os.DirEntry], cache: dict):
+    """
+    Match a raw's candidate XMP DirEntries against the flag cache without
+    opening any of them.
+    Returns (hit, pending): hit is (xmp_file, key, flag) for the first cached
+    candidate, or None; pending lists (xmp_file, key, signature) for the
+    uncached candidates before it, which still need parsing and take priority
+    over hit. Only valid sidecars are cached, so a hit needs no validation.
+    """
+    pending = []
+    for entry in candidates:
+        try:
+            xmp_stat = entry.stat()
+        except OSError:
+            continue
+        if not _is_xmp_candidate(entry.name, xmp_stat.st_size):
+            continue
+
+        key = os.path.abspath(entry.path)
+        signature = _xmp_signature(xmp_stat)
+        hit, flag = _lookup_flag(cache, key, signature)
+        if hit:
+            return (Path(entry.path), key, flag), pending
+        pending.append((Path(entry.path), key, signature))
+
+    return None, pending
+
+
+def _settle_sidecar(hit, pending, index: int | None, flag: str | None, cache: dict):
+    """
+    Combine _match_sidecar's result with _parse_xmp_candidates' result for
+    pending. Caches a newly parsed sidecar and returns (xmp_file, key, flag),
+    or None if the raw has no valid sidecar.
+    """
+    if index is None:
+        return hit
+
+    xmp_file, key, signature = pending[index]
+    cache[key] = [*signature, flag]
+    return xmp_file, key, flag
+
+
+def iter_photos(directory, flag: str, *, forget_yielded: bool = False):
+    """
+    Lazily yield (raw_file, xmp_file) for photos in the directory whose flag is
+    flag ('red', 'green' or 'unflagged').
+    No per-flag result lists are built, but find_raw_files still collects the
+    full list of raw files before the first photo is yielded.
+    Flags of unchanged XMP files are read from the flag cache. Pass
+    forget_yielded when the caller moves or deletes each yielded photo, so its
+    cache entry is dropped.
+    """
+    cache = load_flag_cache()
+    dirty = False
+    try:
+        for dir_photos in _iter_xmp_dirs(find_raw_files(directory)):
+            # Resolve the whole directory first, the caller may change it
+            matches = []
+            for raw_file, candidates in dir_photos:
+                hit, pending = _match_sidecar(candidates, cache)
+                index, xmp_flag = None, None
+                if pending:
+                    index, xmp_flag = _parse_xmp_candidates([xmp_file for xmp_file, _, _ in pending])
+                    dirty = dirty or index is not None
+
+                match = _settle_sidecar(hit, pending, index, xmp_flag, cache)
+                if match is None:
+                    continue
+
+                xmp_file, key, xmp_flag = match
+                if (xmp_flag or 'unflagged') == flag:
+                    matches.append((raw_file, xmp_file, key))
+
+            for raw_file, xmp_file, key in matches:
+                yield raw_file, xmp_file
+                if forget_yielded:
+                    cache.pop(key, None)
+                    dirty = True
+    finally:
+        if dirty:
+            save_flag_cache(cache)
+
+
+def summarize_photos(directory):
     """
     Main function to analyze photos in the directory.
     Only processes files that have corresponding XMP sidecar files.
     Returns a dictionary with counts of red, green, and unflagged photos.
+    Use iter_photos to get the photos themselves.
+    Flags of unchanged XMP files are read from the flag cache.
     """
     raw_files = find_raw_files(directory)
     results = {
@@ -151,54 +421,109 @@ def analyze_photos(directory):
         'skipped_no_xmp': 0
     }
 
-    detailed_results = defaultdict(list)
-
     print(f"Found {len(raw_files)} raw photo files...")
     print("Analyzing only files with valid XMP sidecar files...\n")
 
-    for raw_file in raw_files:
-        xmp_file = find_xmp_file(raw_file)
-
-        if xmp_file:
-            results['total_files'] += 1
-            flag = parse_xmp_flag(xmp_file)
-            if flag == 'red':
-                results['red'] += 1
-                detailed_results['red'].extend([raw_file, xmp_file])
-            elif flag == 'green':
-                results['green'] += 1
-                detailed_results['green'].extend([raw_file, xmp_file])
-            else:
-                results['unflagged'] += 1
-                detailed_results['unflagged'].extend([raw_file, xmp_file])
-        else:
+    cache = load_flag_cache()
+    dirty = False
+    seen = set()
+    to_parse = []
+
+    def count(match):
+        if match is None:
             results['skipped_no_xmp'] += 1
+            return
+        _, key, flag = match
+        seen.add(key)
+        results['total_files'] += 1
+        results[flag or 'unflagged'] += 1
+
+    for dir_photos in _iter_xmp_dirs(raw_files):
+        for _, candidates in dir_photos:
+            hit, pending = _match_sidecar(candidates, cache)
+            if pending:
+                to_parse.append((hit, pending))
+            else:
+                count(hit)
+
+    # XMP parsing is CPU bound and independent per file, so spread it over processes
+    if to_parse:
+        with ProcessPoolExecutor() as executor:
+            candidate_files = [[xmp_file for xmp_file, _, _ in pending] for _, pending in to_parse]
+            parsed = executor.map(_parse_xmp_candidates, candidate_files, chunksize=64)
+            for (hit, pending), (index, flag) in zip(to_parse, parsed):
+                count(_settle_sidecar(hit, pending, index, flag, cache))
+                dirty = dirty or index is not None
+
+    # Forget sidecars under this directory that no longer exist
+    prefix = os.path.join(os.path.abspath(directory), '')
+    stale = [k for k in cache if k.startswith(prefix) and k not in seen]
+    for key in stale:
+        del cache[key]
+
+    if dirty or stale:
+        save_flag_cache(cache)
+
+    return results
 
-    return results, detailed_results
+
+def _replace_or_move(src: str, dst: str):
+    """
+    Rename src to dst, falling back to a cross-device move when src turns out
+    to live on another volume (e.g. one mounted inside the source tree).
+    """
+    try:
+        os.replace(src, dst)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        shutil.move(src, dst)
 
 
 def move_by_flag_and_copy_dir_structure(*, source_dir: Path, flag: str, destination_dir: Path):
     folders_under_source_dir = [f.name for f in source_dir.iterdir() if f.is_dir()]
     # Create the same folder structure under the destination_dir if it does not exist.
 
-    _, detailed_results = analyze_photos(source_dir)
-    target_photos: list[Path] = detailed_results[flag]
-    print(f"Moving {len(target_photos)} to {destination_dir}")
-    for photo in target_photos:
+    destination_dir.mkdir(exist_ok=True, parents=True)
+    # Same filesystem moves are a plain rename, so skip shutil.move's dispatch
+    if source_dir.stat().st_dev == destination_dir.stat().st_dev:
+        move = _replace_or_move
+    else:
+        move = shutil.move
+
+    print(f"Moving {flag} photos to {destination_dir}")
+    moved = 0
+    seen_dirs = set()
+    # An alt-named sidecar (B.xmp) can belong to several raws (B.CR2, B.NEF)
+    moved_xmp_files = set()
+    for raw_file, xmp_file in iter_photos(source_dir, flag, forget_yielded=True):
         # match the mid level dir:
-        dir_name = Path(destination_dir / photo.parents[0].name)
-        dir_name.mkdir(exist_ok=True, parents=True)
-        shutil.move(str(photo), str(dir_name / photo.name))
+        dir_name = Path(destination_dir / raw_file.parents[0].name)
+        if dir_name not in seen_dirs:
+            dir_name.mkdir(exist_ok=True, parents=True)
+            seen_dirs.add(dir_name)
+        move(str(raw_file), str(dir_name / raw_file.name))
+        if xmp_file not in moved_xmp_files:
+            move(str(xmp_file), str(dir_name / xmp_file.name))
+            moved_xmp_files.add(xmp_file)
+        moved += 1
+
+    print(f"Moved {moved} photos to {destination_dir}")
 
 
 def delete_by_flag(*, source_dir: Path, flag: str, simulate: bool = False):
-    _, detailed_results = analyze_photos(source_dir)
-    target_photos: list[Path] = detailed_results[flag]
+    count = 0
+    # An alt-named sidecar (B.xmp) can belong to several raws (B.CR2, B.NEF)
+    deleted_xmp_files = set()
+    for raw_file, xmp_file in iter_photos(source_dir, flag, forget_yielded=not simulate):
+        if not simulate:
+            raw_file.unlink()
+            if xmp_file not in deleted_xmp_files:
+                xmp_file.unlink()
+                deleted_xmp_files.add(xmp_file)
+        count += 1
 
     if not simulate:
-        for photo in target_photos:
-            photo.unlink()
-
-        print(f"Deleted {len(target_photos)/2} photos")
+        print(f"Deleted {count} photos")
     else:
-        print(f"Simulated run would have deleted {len(target_photos)/2} photos")
\ No newline at end of file
+        print(f"Simulated run would have deleted {count} photos")